@@ -26,16 +26,31 @@
 # -----------------------------------------------------------------------------
 
 import io
-import toml
-import requests
+import os
+import asyncio
+import aiohttp
+import threading
 import json
 import logging
-import time
 from datetime import datetime, timedelta
 
 from snipsTools import SnipsConfigParser
-from hermes_python.hermes import Hermes
-from hermes_python.ontology import *
+
+# toml and hermes_python are imported lazily in read_toml()/start() -
+# both are expensive to import on Pi-class hardware and only needed once
+
+# fast JSON parser for the RMV responses (accepts bytes directly),
+# fall back to ujson/stdlib if unavailable
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
 
 # -----------------------------------------------------------------------------
 # global definitions (RMV service endpoints)
@@ -46,12 +61,23 @@ TRIP_SVC = "https://www.rmv.de/hapi/trip"
 
 APP_ID = "snips-skill-s710-rmv"
 
+CACHE_FILE = os.path.expanduser("~/.cache/snipsrmv/locations.json")
+
+# train categories that are spoken before the train name ("U-Bahn U4")
+
+PREFIXED_CATEGORIES = frozenset({ "U-Bahn", "S-Bahn" })
+
 # -----------------------------------------------------------------------------
 # class App
 # -----------------------------------------------------------------------------
 
 class App(object):
 
+    __slots__ = ("logger", "debug", "mqtt_host", "mqtt_user", "mqtt_pass", "config",
+                 "rmv_api_key", "rmv_homestation", "rmv_homecity", "rmv_homecity_only",
+                 "short_info", "time_offset", "_offset_td", "_loc_params_base",
+                 "_trip_params_base", "_http", "_loop", "_location_cache")
+
     # -------------------------------------------------------------------------
     # ctor
 
@@ -66,13 +92,6 @@ class App(object):
         self.mqtt_user = None
         self.mqtt_pass = None
 
-        self.rmv_api_key = None
-        self.rmv_homestation = None
-        self.rmv_homecity = None
-        self.rmv_homecity_only = True
-        self.time_offset = None
-        self.short_info = False
-        
         # read config.ini (HASS host + token)
 
         try:
@@ -86,23 +105,42 @@ class App(object):
         except Exception as e:
             self.logger.error("Failed to read /etc/snips.toml ({})".format(e))
 
-        if 'rmv_api_key' in self.config['secret']:
-            self.rmv_api_key = self.config['secret']['rmv_api_key']
+        # single pass over the config sections instead of one lookup per key
+
+        g = self.config.get('global', {}) if self.config else {}
+        s = self.config.get('secret', {}) if self.config else {}
+
+        self.rmv_api_key = s.get('rmv_api_key')
+        self.rmv_homestation = g.get('rmv_homestation')
+        self.rmv_homecity = g.get('rmv_homecity')
+        self.rmv_homecity_only = g.get('rmv_homecity_only') != "False"
+        self.short_info = g.get('short_info') == "True"
 
-        if 'rmv_homestation' in self.config['global']:
-            self.rmv_homestation = self.config['global']['rmv_homestation']
+        time_offset = g.get('time_offset')
+        self.time_offset = int(time_offset) if time_offset else None
+        self._offset_td = timedelta(minutes = self.time_offset) if self.time_offset else None
 
-        if 'rmv_homecity' in self.config['global']:
-            self.rmv_homecity = self.config['global']['rmv_homecity']
-        
-        if 'rmv_homecity_only' in self.config['global'] and self.config['global']['rmv_homecity_only'] == "False":
-            self.rmv_homecity_only = False
+        # constant request parameters, built once instead of per call
 
-        if 'time_offset' in self.config['global']:
-            self.time_offset = int(self.config['global']['time_offset'])
+        self._loc_params_base = { "accessId": self.rmv_api_key, "type": "S", "format": "json", "maxNo": "1" }
+        self._trip_params_base = { "accessId": self.rmv_api_key, "format": "json" }
 
-        if 'short_info' in self.config['global'] and self.config['global']['short_info'] == "True":
-            self.short_info = True
+        # persistent event loop for the RMV queries (aiohttp session is
+        # created lazily on first use, since it must be born on the loop)
+
+        self._http = None
+        self._loop = asyncio.new_event_loop()
+
+        threading.Thread(target = self._loop.run_forever, daemon = True).start()
+
+        # location lookups repeat heavily (the origin is constant), so keep
+        # resolved IDs in a persistent cache and pre-warm the origin entry
+
+        self._location_cache = self.load_cache()
+
+        if self.rmv_api_key and self.rmv_homestation:
+            future = asyncio.run_coroutine_threadsafe(self.get_location_id(self.rmv_homestation, self.rmv_homecity), self._loop)
+            future.add_done_callback(self.on_prewarm_done)
 
         self.logger.debug("Connecting to {}@{} ...".format(self.mqtt_user, self.mqtt_host))
 
@@ -112,6 +150,8 @@ class App(object):
     # read_toml
 
     def read_toml(self):
+        import toml
+
         snips_config = toml.load('/etc/snips.toml')
     
         if 'mqtt' in snips_config['snips-common'].keys():
@@ -123,10 +163,48 @@ class App(object):
         if 'mqtt_password' in snips_config['snips-common'].keys():
             self.mqtt_pass = snips_config['snips-common']['mqtt_password']
 
+    # -------------------------------------------------------------------------
+    # on_prewarm_done
+
+    def on_prewarm_done(self, future):
+        # consume the pre-warm result so a failed lookup (e.g. network not up
+        # yet at boot) is logged instead of dumped by GC as an unretrieved
+        # future exception
+
+        e = future.exception()
+
+        if e is not None:
+            self.logger.error("Failed to pre-warm location cache ({})".format(e))
+
+    # -------------------------------------------------------------------------
+    # load_cache
+
+    def load_cache(self):
+        try:
+            with io.open(CACHE_FILE, encoding = 'utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    # -------------------------------------------------------------------------
+    # save_cache
+
+    def save_cache(self):
+        try:
+            os.makedirs(os.path.dirname(CACHE_FILE), exist_ok = True)
+
+            with io.open(CACHE_FILE, 'w', encoding = 'utf-8') as f:
+                json.dump(self._location_cache, f)
+        except Exception as e:
+            self.logger.error("Failed to write location cache ({})".format(e))
+
     # -------------------------------------------------------------------------
     # start
 
     def start(self):
+        from hermes_python.hermes import Hermes
+        from hermes_python.ontology import MqttOptions
+
         with Hermes(mqtt_options = MqttOptions(broker_address = self.mqtt_host, username = self.mqtt_user, password = self.mqtt_pass)) as h:
             h.subscribe_intents(self.on_intent).start()
 
@@ -152,40 +230,76 @@ class App(object):
             pass
 
         if intent_name == 's710:getTrainTo':
-            response = self.query(hermes, intent_message, location, dep_time)
-            self.done(hermes, intent_message, response)
+            # hand the query to the event loop and answer from its completion
+            # callback, so the MQTT dispatch thread is not blocked while the
+            # RMV requests are in flight
+
+            future = asyncio.run_coroutine_threadsafe(self.query(hermes, intent_message, location, dep_time), self._loop)
+            future.add_done_callback(lambda f: self.on_query_done(hermes, intent_message, f))
 
     # -------------------------------------------------------------------------
-    # query
+    # on_query_done
 
-    def query(self, hermes, intent_message, location, dep_time):
-        tme = dep_time
-        dest_id = None
+    def on_query_done(self, hermes, intent_message, future):
+        try:
+            response = future.result()
+        except Exception as e:
+            self.logger.error("Failed to query trip ({})".format(e))
+            response = None
 
-        # origin-ID according to homecity config
+        self.done(hermes, intent_message, response)
 
-        origin_id = self.get_location_id(self.rmv_homestation, self.rmv_homecity)
+    # -------------------------------------------------------------------------
+    # get_session
 
-        # determine destination-ID according to supplied station
+    def get_session(self):
+        if self._http is None:
+            # reuse pooled keep-alive connections so each intent pays the
+            # TCP+TLS handshake to www.rmv.de at most once
 
-        if (self.rmv_homecity_only):
-            dest_id = self.get_location_id(location, self.rmv_homecity)
-        else:
-            dest_id = self.get_location_id(location)
+            self._http = aiohttp.ClientSession(
+                connector = aiohttp.TCPConnector(limit = 4, limit_per_host = 4, keepalive_timeout = 60),
+                timeout = aiohttp.ClientTimeout(total = 6, sock_connect = 2, sock_read = 4),
+                headers = { "Accept": "application/json", "Connection": "keep-alive" })
+
+        return self._http
 
-        if not origin_id or not dest_id:
-            self.logger.error("Failed to determine stops")
+    # -------------------------------------------------------------------------
+    # query
+
+    async def query(self, hermes, intent_message, location, dep_time):
+        tme = dep_time
+
+        if not location:
+            self.logger.error("No destination given")
             return False
 
         # set time to now + offset if no time given & we have offset in config
 
-        if not tme and self.time_offset:
-            dt = datetime.fromtimestamp(time.time()) + timedelta(minutes = self.time_offset)
-            tme = dt.strftime("%H:%M:00")
+        if not tme and self._offset_td:
+            tme = (datetime.now() + self._offset_td).strftime("%H:%M:00")
+
+        # fast path: let the trip service resolve the station names
+        # server-side - one roundtrip instead of three
+
+        origin_name = f"{self.rmv_homestation} {self.rmv_homecity}" if self.rmv_homecity else self.rmv_homestation
+        dest_name = f"{location} {self.rmv_homecity}" if self.rmv_homecity_only and self.rmv_homecity else location
+
+        stops = await self.get_trip({ "originName": origin_name, "destName": dest_name }, origin_name, dest_name, tme)
 
-        # get the trip
+        # fallback: resolve origin/destination extIds (cached, concurrent)
+        # and query the trip by ID
 
-        stops = self.get_trip(origin_id, dest_id, tme)
+        if stops is None:
+            origin_id, dest_id = await asyncio.gather(
+                self.get_location_id(self.rmv_homestation, self.rmv_homecity),
+                self.get_location_id(location, self.rmv_homecity if self.rmv_homecity_only else None))
+
+            if not origin_id or not dest_id:
+                self.logger.error("Failed to determine stops")
+                return False
+
+            stops = await self.get_trip({ "originExtId": origin_id[0], "destExtId": dest_id[0] }, origin_id[1], dest_id[1], tme)
 
         if stops is None:
             self.logger.error("Failed to query trip")
@@ -203,66 +317,68 @@ class App(object):
     # -------------------------------------------------------------------------
     # get_location_id
 
-    def get_location_id(self, location_name, city = None):
-        params = { "accessId": self.rmv_api_key, "type": "S", "format": "json", "maxNo": 1, "input": location_name }
+    async def get_location_id(self, location_name, city = None):
+        cache_key = "{}|{}".format(location_name, city or "")
+
+        if cache_key in self._location_cache:
+            return tuple(self._location_cache[cache_key])
 
-        if (city is not None):
-            params["input"] = location_name + " " + city
+        params = { **self._loc_params_base, "input": f"{location_name} {city}" if city is not None else location_name }
 
-        r = requests.get(LOCATION_SVC, params = params)
+        async with self.get_session().get(LOCATION_SVC, params = params) as r:
+            content = await r.read()
 
-        if r.status_code != 200 or not r.content:
-            self.logger.error("Failed to determine location '{}' (HTTP {})".format(location_name, r.status_code))
+        if r.status != 200 or not content:
+            self.logger.error("Failed to determine location '{}' (HTTP {})".format(location_name, r.status))
             return None
 
         try:
-            dict = json.loads(r.content.decode('utf-8'))
-        except ValueError as e:
-            self.logger.error("Failed to parse location query response ({})".format(e))
-            return None
-        except TypeError as e:
-            self.logger.error("Failed to parse location query response ({})".format(e))
-            return None
-        except Exception as e:
+            payload = json_loads(content)
+        except (ValueError, TypeError) as e:
             self.logger.error("Failed to parse location query response ({})".format(e))
             return None
 
-        if "stopLocationOrCoordLocation" not in dict or not isinstance(dict["stopLocationOrCoordLocation"], list):
+        if "stopLocationOrCoordLocation" not in payload or not isinstance(payload["stopLocationOrCoordLocation"], list):
             return None
 
-        if "StopLocation" not in dict["stopLocationOrCoordLocation"][0]:
+        if "StopLocation" not in payload["stopLocationOrCoordLocation"][0]:
             return None
 
-        stop = dict["stopLocationOrCoordLocation"][0]["StopLocation"]
+        stop = payload["stopLocationOrCoordLocation"][0]["StopLocation"]
+
+        self._location_cache[cache_key] = (stop["extId"], stop["name"])
+
+        # persist off the event loop - the JSON write hits slow SD-card
+        # storage and must not stall in-flight queries
+
+        asyncio.get_running_loop().run_in_executor(None, self.save_cache)
 
         return (stop["extId"], stop["name"])
 
     # -------------------------------------------------------------------------
     # get_trip
 
-    def get_trip(self, origin_id, dest_id, time):
-        params = { "accessId": self.rmv_api_key, "format": "json", "originExtId": origin_id[0], "destExtId": dest_id[0] }
+    async def get_trip(self, trip_params, origin_name, dest_name, time):
+        params = { **self._trip_params_base, **trip_params }
 
         if time is not None:
             params["time"] = time
 
-        r = requests.get(TRIP_SVC, params = params)
+        async with self.get_session().get(TRIP_SVC, params = params) as r:
+            content = await r.read()
 
-        if r.status_code != 200 or not r.content:
-            self.logger.error("Failed to query trip from '{}' to '{}' (HTTP {})".format(origin_id[1], dest_id[1], r.status_code))
+        if r.status != 200 or not content:
+            self.logger.error("Failed to query trip from '{}' to '{}' (HTTP {})".format(origin_name, dest_name, r.status))
             return None
 
         try:
-            dict = json.loads(r.content.decode('utf-8'))
-        except ValueError as e:
-            self.logger.error("Failed to parse trip query response ({})".format(e))
-            return None
-        except TypeError as e:
+            payload = json_loads(content)
+        except (ValueError, TypeError) as e:
             self.logger.error("Failed to parse trip query response ({})".format(e))
             return None
 
         try:
-            first_leg_list = dict["Trip"][0]["LegList"]["Leg"]
+            first_leg_list = payload["Trip"][0]["LegList"]["Leg"]
         except:
             self.logger.error("Unexpected response for trip query")
             return None
@@ -277,7 +393,9 @@ class App(object):
 
         for leg in leg_list:
             try:
-                stop = { "time": ":".join(leg["Origin"]["time"].split(":")[:2]), "arrival": ":".join(leg["Destination"]["time"].split(":")[:2]), "station": leg["Origin"]["name"], "dest_station": leg["Destination"]["name"] }
+                # RMV returns fixed "HH:MM:SS" strings, so a slice trims to "HH:MM"
+
+                stop = { "time": leg["Origin"]["time"][:5], "arrival": leg["Destination"]["time"][:5], "station": leg["Origin"]["name"], "dest_station": leg["Destination"]["name"] }
 
                 if "direction" in leg:
                     stop["direction"] = leg["direction"]
@@ -295,6 +413,13 @@ class App(object):
 
                 stops.append(stop)
 
+                # short-info only announces the first train leg, so skip the
+                # remaining legs and keep just the trip's final arrival time
+
+                if self.short_info and stop.get("category") != "walk":
+                    stop["arrival"] = leg_list[-1]["Destination"]["time"][:5]
+                    break
+
             except KeyError as e:
                 self.logger.error("Unexpected response contents for trip query (leg list) ({})".format(e))
                 return None
@@ -308,38 +433,32 @@ class App(object):
     # make_response
 
     def make_response(self, stops):
-        response_string = ""
-
         if not stops:
             return None
 
-        for i in range(len(stops)):
-            stop = stops[i]
+        parts = []
+        append = parts.append
 
+        for i, stop in enumerate(stops):
             if stop["category"] == "walk":
-                response_string += stop["distance"] + " Meter laufen bis " + stop["dest_station"] + ". "
+                append(f"{stop['distance']} Meter laufen bis {stop['dest_station']}. ")
             else:
                 if i == 0:
-                    response_string += self.get_train_title(stop["category"], stop["train"]) + " Richtung " + stop["direction"] + " um " + stop["time"] + " Uhr. "
+                    append(f"{self.get_train_title(stop['category'], stop['train'])} Richtung {stop['direction']} um {stop['time']} Uhr. ")
                 else:
-                    response_string += "Umsteigen an " + stop["station"] +  " zu " + self.get_train_title(stop["category"], stop["train"]) + " Richtung " + stop["direction"] + " um " + stop["time"] + " Uhr. "
+                    append(f"Umsteigen an {stop['station']} zu {self.get_train_title(stop['category'], stop['train'])} Richtung {stop['direction']} um {stop['time']} Uhr. ")
 
                 if self.short_info:
                     break
 
-        last = stops[-1]
-
-        response_string += "Ankunft um " + last["arrival"] + " Uhr."
-        return response_string
+        append(f"Ankunft um {stops[-1]['arrival']} Uhr.")
+        return "".join(parts)
 
     # -------------------------------------------------------------------------
     # get_train_title
 
     def get_train_title(self, category, train):
-        if category == "U-Bahn" or category == "S-Bahn":
-            return category + " " + train
-
-        return train
+        return f"{category} {train}" if category in PREFIXED_CATEGORIES else train
 
     # -------------------------------------------------------------------------
     # done